@@ -5,26 +5,42 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import atexit
+import ctypes
+import fcntl
+import itertools
+import os
+import stat
 import struct
 import time
 import socket
 from dataclasses import dataclass, field
 from ipaddress import IPv4Network, IPv4Address, AddressValueError
-from threading import Lock, Thread
-from typing import Dict, Generator, Optional, IO, Union
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, IO, Union
 
-import ifcfg
 from scapy import all as scapy
 from scapy.contrib import pfcp
 from scapy.layers.inet import IP, UDP
 from scapy.layers.l2 import Ether
-from scapy.utils import wrpcap
+from scapy.utils import PcapWriter
 
 MSG_TYPES = {name: num for num, name in pfcp.PFCPmessageType.items()}
 CAUSE_TYPES = {name: num for num, name in pfcp.CauseValues.items()}
 IE_TYPES = {name: num for num, name in pfcp.IEType.items()}
 HEARTBEAT_PERIOD = 5  # in seconds
+RESPONSE_TIMEOUT = 5  # in seconds
 UDP_PORT_PFCP = 8805
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)  # not exposed by older Python versions
+UDP_MAX_SEGMENTS = 64  # kernel cap on segments per GSO write
+UDP_MAX_PAYLOAD = 65507
+# Large establish/modification responses (many created PDRs/F-TEIDs) can approach the
+# UDP maximum; a short recvfrom buffer would silently truncate them and break dissection
+RECV_BUFFER_SIZE = 65535
+SOCKET_BUFFER_SIZE = 12 * 1024 * 1024  # big enough to absorb response bursts at high session counts
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33)
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32)
+SIOCGIFADDR = 0x8915
 IFACE_ACCESS = 0
 IFACE_CORE = 1
 
@@ -46,10 +62,21 @@ class Session:
     uplink: UeFlow = None
     downlink: UeFlow = None
     disable_caching: bool = False
-    sent_pdrs: Dict[int, pfcp.IE_Compound] = field(default_factory=dict)
-    sent_fars: Dict[int, pfcp.IE_Compound] = field(default_factory=dict)
-    sent_urrs: Dict[int, pfcp.IE_Compound] = field(default_factory=dict)
-    sent_qers: Dict[int, pfcp.IE_Compound] = field(default_factory=dict)
+    # Sent rules are cached as serialized bytes, so checking whether a rule changed
+    # is a single C-level comparison instead of a recursive scapy object walk
+    sent_pdrs: Dict[int, bytes] = field(default_factory=dict)
+    sent_fars: Dict[int, bytes] = field(default_factory=dict)
+    sent_urrs: Dict[int, bytes] = field(default_factory=dict)
+    sent_qers: Dict[int, bytes] = field(default_factory=dict)
+
+    def __post_init__(self):
+        # Built once so the per-rule hot path doesn't rebuild the dispatch dict on every call
+        self._rule_caches = {
+            "pdr": self.sent_pdrs,
+            "far": self.sent_fars,
+            "urr": self.sent_urrs,
+            "qer": self.sent_qers
+        }
 
     def clear_sent_rules(self):
         """
@@ -85,20 +112,14 @@ class Session:
                       (rule_type, rule_id, self.our_seid))
             req.IE_list.append(rule)
             return
-        rule_cache: dict
-        rule_type_to_dict = {
-            "pdr": self.sent_pdrs,
-            "far": self.sent_fars,
-            "urr": self.sent_urrs,
-            "qer": self.sent_qers
-        }
-        rule_cache = rule_type_to_dict.get(rule_type, None)
+        rule_cache = self._rule_caches.get(rule_type, None)
         if rule_cache is None:
             raise Exception("Bad rule type passed to rule cacher")
 
         previous_rule = rule_cache.get(rule_id, None)
-        rule_cache[rule_id] = rule
-        if previous_rule is None or previous_rule != rule:
+        rule_bytes = bytes(rule)
+        rule_cache[rule_id] = rule_bytes
+        if previous_rule is None or previous_rule != rule_bytes:
             if verbosity > 0:
                 print("Adding %s with ID %d to request for SEID %d" %
                       (rule_type, rule_id, self.our_seid))
@@ -151,27 +172,223 @@ class Session:
 # Global non-constants
 our_addr: str = ""
 peer_addr: str = ""
-sequence_number: int = 0
-thread_lock = Lock()
+sequence_number = itertools.count(1)
 association_established = False
-script_terminating = False
+terminate_event = Event()  # set when the script is shutting down
+# Serializes request/response exchanges on the shared socket, so the heartbeat
+# thread and the user input thread never dequeue each other's replies
+exchange_lock = Lock()
 active_sessions: Dict[int, Session] = {}
-pcap_filename: Optional[str] = None
+pcap_writer: Optional[PcapWriter] = None
 verbosity: int = 0
+sock: Optional[socket.socket] = None
+udp_gso_supported: bool = False
 # End global non-constants
 
 
-def capture(pkt: scapy.Packet):
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+try:
+    _sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+except (OSError, AttributeError):
+    # Not a libc with sendmmsg(2); send_batch() will fall back to per-packet sends
+    _sendmmsg = None
+
+# Precompiled codecs for the hot send/receive paths, so repeated packs/unpacks skip
+# re-parsing the format string every call
+_GSO_SIZE_STRUCT = struct.Struct("H")
+_PFCP_MSG_HEADER_STRUCT = struct.Struct("!BB")
+_IE_HEADER_STRUCT = struct.Struct("!HH")
+_SEID_STRUCT = struct.Struct("!Q")
+
+
+def get_iface_ipv4(ifname: str) -> str:
+    """
+    Resolve the primary IPv4 address of the given interface with the SIOCGIFADDR
+    ioctl, straight from the kernel.
+    :param ifname: the name of the interface to resolve
+    :return: the interface's IPv4 address as a string
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ioctl_sock:
+        ifreq = struct.pack("256s", ifname.encode()[:15])
+        addr = fcntl.ioctl(ioctl_sock.fileno(), SIOCGIFADDR, ifreq)[20:24]
+    return socket.inet_ntoa(addr)
+
+
+def open_socket() -> None:
+    """
+    Open the UDP socket used for exchanging PFCP messages with the peer.
+    :return: None
+    """
+    global sock, udp_gso_supported
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    _bump_socket_buffers()
+    sock.bind((our_addr, our_port))
+    # Connecting a UDP socket pins the route and peer once, so every send skips the
+    # per-datagram route lookup sendto() pays on an unconnected socket
+    sock.connect((peer_addr, peer_port))
+    sock.settimeout(RESPONSE_TIMEOUT)
+    udp_gso_supported = _probe_udp_gso()
+    if verbosity > 0 and not udp_gso_supported:
+        print("UDP GSO not supported by this kernel, batches will be sent per-packet")
+
+
+def _bump_socket_buffers() -> None:
+    """
+    Raise the socket send and receive buffers so response bursts from the UPF at high
+    session counts don't overflow the kernel defaults and get silently dropped.
+    Warn if the kernel clamped the requested size to rmem_max/wmem_max.
+    :return: None
+    """
+    for opt, force_opt, sysctl in [(socket.SO_RCVBUF, SO_RCVBUFFORCE, "net.core.rmem_max"),
+                                   (socket.SO_SNDBUF, SO_SNDBUFFORCE, "net.core.wmem_max")]:
+        try:
+            # The *FORCE variants bypass the rmem_max/wmem_max clamps, but need CAP_NET_ADMIN
+            sock.setsockopt(socket.SOL_SOCKET, force_opt, SOCKET_BUFFER_SIZE)
+        except (OSError, PermissionError):
+            sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER_SIZE)
+        # The kernel reports double the configured value to account for bookkeeping overhead
+        actual = sock.getsockopt(socket.SOL_SOCKET, opt) // 2
+        if actual < SOCKET_BUFFER_SIZE:
+            print("WARNING: kernel clamped socket buffer to %d bytes (wanted %d), "
+                  "consider raising %s to %d" % (actual, SOCKET_BUFFER_SIZE, sysctl,
+                                                 SOCKET_BUFFER_SIZE))
+
+
+def _probe_udp_gso() -> bool:
+    """
+    Check whether the kernel supports UDP GSO (UDP_SEGMENT) by attempting a tiny
+    segmented write on a throwaway loopback socket.
+    :return: True if the GSO write succeeds, False otherwise
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.bind(("127.0.0.1", 0))
+        probe.sendmsg([b"\x00\x00"], [(socket.IPPROTO_UDP, UDP_SEGMENT, _GSO_SIZE_STRUCT.pack(1))], 0,
+                      probe.getsockname())
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def send_batch(pkts) -> None:
+    """
+    Serialize and send a batch of PFCP packets with as few syscalls as possible.
+    When libc exposes sendmmsg(2), a single kernel crossing covers the whole batch;
+    otherwise fall back to one sendmsg(2) call per packet.
+    :param pkts: the packets to send, as crafted by the craft_pfcp_* functions
+    :return: None
+    """
+    if not pkts:
+        return
+    payloads = []
+    for pkt in pkts:
+        capture(pkt)
+        payloads.append(scapy.raw(pkt[pfcp.PFCP]))
+    if len(payloads) > 1 and udp_gso_supported and _send_payloads_gso(payloads):
+        return
+    if _sendmmsg is not None:
+        _send_payloads_mmsg(payloads)
+    else:
+        for payload in payloads:
+            sock.sendmsg([payload])
+
+
+def _send_payloads_gso(payloads) -> bool:
+    """
+    Try sending equal-sized serialized payloads as concatenated UDP GSO writes, so the
+    kernel segments each write into individual datagrams instead of us paying a syscall
+    and protocol walk per datagram.
+    :param payloads: the serialized PFCP messages to send
+    :return: True if the payloads were sent, False if they are not eligible for GSO or
+    the write failed and the caller should fall back to per-datagram sends
+    """
+    # GSO requires all segments but the last to be the same size
+    seg_size = len(payloads[0])
+    if any(len(payload) != seg_size for payload in payloads[:-1]) or len(
+            payloads[-1]) > seg_size:
+        return False
+    max_segs = min(UDP_MAX_SEGMENTS, UDP_MAX_PAYLOAD // seg_size)
+    if max_segs < 2:
+        return False
+    cmsg = [(socket.IPPROTO_UDP, UDP_SEGMENT, _GSO_SIZE_STRUCT.pack(seg_size))]
+    for i in range(0, len(payloads), max_segs):
+        try:
+            sock.sendmsg([b"".join(payloads[i:i + max_segs])], cmsg)
+        except OSError:
+            if i == 0:
+                # Nothing hit the wire yet, the caller may retry the whole batch
+                return False
+            # Earlier chunks were already delivered; finish only the unsent
+            # remainder with per-datagram sends so nothing goes out twice
+            for payload in payloads[i:]:
+                sock.sendmsg([payload])
+            return True
+    return True
+
+
+def _send_payloads_mmsg(payloads) -> None:
+    """
+    Send the given serialized payloads to the peer via sendmmsg(2).
+    :param payloads: the serialized PFCP messages to send
+    :return: None
+    """
+    bufs = [ctypes.create_string_buffer(payload, len(payload)) for payload in payloads]
+    iovecs = (_IOVec * len(payloads))()
+    msgs = (_MMsgHdr * len(payloads))()
+    for i, buf in enumerate(bufs):
+        iovecs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+        iovecs[i].iov_len = len(payloads[i])
+        # msg_name stays NULL: the socket is connected, the kernel knows the peer
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    sent = 0
+    while sent < len(payloads):
+        result = _sendmmsg(sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(_MMsgHdr)),
+                           len(payloads) - sent, 0)
+        if result <= 0:
+            # Finish the remainder one datagram at a time
+            for payload in payloads[sent:]:
+                sock.sendmsg([payload])
+            return
+        sent += result
+
+
+def capture(pkt: scapy.Packet, from_peer: bool = False):
     """
     Write the given packet to the PCAP file that was defined when the mock SMF was launched.
-    If no such file was given, do nothing.
+    If no such file was given, do nothing. Bare PFCP packets are wrapped in the Ether/IP/UDP
+    headers that the kernel adds on the wire, constructed only when a capture file is in use.
     :param pkt: The packet to record in the PCAP file
+    :param from_peer: True if the packet was received from the peer, False if we sent it
     :return:
     """
+    if not pcap_writer:
+        return
     if Ether not in pkt:
+        if IP not in pkt:
+            if from_peer:
+                pkt = IP(src=peer_addr, dst=our_addr) / UDP(sport=peer_port, dport=our_port) / pkt
+            else:
+                pkt = IP(src=our_addr, dst=peer_addr) / UDP(sport=our_port, dport=peer_port) / pkt
         pkt = Ether() / pkt
-    if pcap_filename:
-        wrpcap(pcap_filename, pkt, append=True)
+    pcap_writer.write(pkt)
 
 
 def get_sessions_from_args(args: argparse.Namespace, create_if_missing: bool = False):
@@ -182,13 +399,16 @@ def get_sessions_from_args(args: argparse.Namespace, create_if_missing: bool = F
     create it. Otherwise the SEID is skipped
     :return:
     """
-    ue_addr_gen = get_addresses_from_prefix(args.ue_pool, args.session_count)
-    seid_gen = iter(
-        range(args.base if args.base else args.seid_base,
-              (args.base if args.base else args.seid_base) + args.session_count))
-    teid_gen = iter(
-        range(args.base if args.base else args.teid_base,
-              (args.base if args.base else args.teid_base) + args.session_count * 2))
+    # Resolve the --base overrides once instead of re-evaluating them for every session
+    seid_base = args.base if args.base else args.seid_base
+    teid_base = args.base if args.base else args.teid_base
+    pdr_base = args.base if args.base else args.pdr_base
+    far_base = args.base if args.base else args.far_base
+    qer_base = args.base if args.base else args.qer_base
+    urr_base = args.base if args.base else args.urr_base
+    ue_addr_gen = iter(get_addresses_from_prefix(args.ue_pool, args.session_count))
+    seid_gen = iter(range(seid_base, seid_base + args.session_count))
+    teid_gen = iter(range(teid_base, teid_base + args.session_count * 2))
 
     for _ in range(args.session_count):
         seid: int = next(seid_gen)
@@ -197,42 +417,34 @@ def get_sessions_from_args(args: argparse.Namespace, create_if_missing: bool = F
         elif create_if_missing:
             active_sessions[seid] = Session(
                 our_seid=seid, ue_addr=next(ue_addr_gen),
-                uplink=UeFlow(teid=next(teid_gen), pdr_id=args.base if args.base else args.pdr_base,
-                              far_id=args.base if args.base else args.far_base,
-                              qer_id=args.base if args.base else args.qer_base,
-                              urr_id=args.urr_base),
-                downlink=UeFlow(teid=next(teid_gen),
-                                pdr_id=(args.base if args.base else args.pdr_base) + 1,
-                                far_id=(args.base if args.base else args.far_base) + 1,
-                                qer_id=(args.base if args.base else args.qer_base) + 1,
-                                urr_id=(args.base if args.base else args.urr_base) + 1))
+                uplink=UeFlow(teid=next(teid_gen), pdr_id=pdr_base, far_id=far_base,
+                              qer_id=qer_base, urr_id=args.urr_base),
+                downlink=UeFlow(teid=next(teid_gen), pdr_id=pdr_base + 1, far_id=far_base + 1,
+                                qer_id=qer_base + 1, urr_id=urr_base + 1))
             yield active_sessions[seid]
         else:
             print("WARNING: skipping invalid session with ID %d" % seid)
             continue
 
 
-def get_addresses_from_prefix(prefix: IPv4Network,
-                              count: int) -> Generator[IPv4Address, None, None]:
+def get_addresses_from_prefix(prefix: IPv4Network, count: int) -> List[IPv4Address]:
     """
-    Generator for yielding Ip4Addresses from the provided prefix.
+    Bulk-generate Ip4Addresses from the provided prefix.
     :param prefix: the prefix from which addresses should be generated
-    :param count: how many addresses to yield
-    :return: an address generator
+    :param count: how many addresses to generate
+    :return: a list of `count` addresses
     """
     # Currently this doesn't allow the address with host bits all 0,
     #  so the first host address is (prefix_addr & mask) + 1
     if count >= 2**(prefix.max_prefixlen - prefix.prefixlen):
         raise Exception("trying to generate more addresses than a prefix contains!")
     base_addr = ip2int(prefix.network_address) + 1
-    offset = 0
-    while offset < count:
-        yield IPv4Address(base_addr + offset)
-        offset += 1
+    return [IPv4Address(addr) for addr in range(base_addr, base_addr + count)]
 
 
 def ip2int(addr: IPv4Address):
-    return struct.unpack("!I", addr.packed)[0]
+    # IPv4Address converts to its integer form directly, no pack/unpack round trip needed
+    return int(addr)
 
 
 def int2ip(addr: int):
@@ -242,16 +454,40 @@ def int2ip(addr: int):
 def get_sequence_num(reset=False):
     """
     Generate a sequence number for a PFCP message.
+    next() on a shared itertools.count is atomic under the GIL, so no lock is needed
+    even though the heartbeat and user-input threads both draw from it.
     :param reset: if true, resets the sequence number counter
     :return: a sequence number to be used in a PFCP message
     """
-    thread_lock.acquire()
     global sequence_number
     if reset:
-        sequence_number = 0
-    sequence_number += 1
-    thread_lock.release()
-    return sequence_number
+        sequence_number = itertools.count(1)
+    return next(sequence_number)
+
+
+# Pre-serialized IEs, keyed by type and field values
+_frozen_ie_cache: Dict[tuple, scapy.Packet] = {}
+
+
+def frozen_ie(ie_cls, **fields) -> scapy.Packet:
+    """
+    Return a pre-serialized copy of the given IE, cached by IE type and field values.
+    Scapy re-encodes every IE object each time a request is serialized; IEs whose
+    contents don't vary between requests can instead be encoded once and substituted
+    into each request as raw bytes.
+    :param ie_cls: the scapy class of the IE to build
+    :param fields: the field values to set on the IE
+    :return: a scapy Raw packet holding the serialized IE
+    """
+    key = (ie_cls, tuple(sorted(fields.items())))
+    frozen = _frozen_ie_cache.get(key)
+    if frozen is None:
+        ie = ie_cls()
+        for name, value in fields.items():
+            setattr(ie, name, value)
+        frozen = scapy.Raw(scapy.raw(ie))
+        _frozen_ie_cache[key] = frozen
+    return frozen
 
 
 def craft_fseid(seid: int, address: str) -> pfcp.IE_Compound:
@@ -267,18 +503,13 @@ def craft_pdr(session: Session, flow: UeFlow, src_iface: int, from_tunnel=False,
     pdr = pfcp.IE_UpdatePDR() if flow.pdr_id in session.sent_pdrs else pfcp.IE_CreatePDR()
     pdr_id = pfcp.IE_PDR_Id()
     pdr_id.id = flow.pdr_id
-    pdr.IE_list.append(pdr_id)
-    _precedence = pfcp.IE_Precedence()
-    _precedence.precedence = precedence
-    pdr.IE_list.append(_precedence)
+    # Collect the IEs in local lists and attach them with one assignment at the end,
+    # instead of growing the scapy list fields append by append
+    pdr_ies = [pdr_id, frozen_ie(pfcp.IE_Precedence, precedence=precedence)]
 
-    # Packet Detection Information
+    # Packet Detection Information, starting with the source interface
     pdi = pfcp.IE_PDI()
-
-    # Source interface
-    source_interface = pfcp.IE_SourceInterface()
-    source_interface.interface = src_iface
-    pdi.IE_list.append(source_interface)
+    pdi_ies = [frozen_ie(pfcp.IE_SourceInterface, interface=src_iface)]
 
     if from_tunnel:
         if tunnel_dst is None or flow.teid is None:
@@ -288,11 +519,9 @@ def craft_pdr(session: Session, flow: UeFlow, src_iface: int, from_tunnel=False,
         fteid.V4 = 1
         fteid.TEID = flow.teid
         fteid.ipv4 = tunnel_dst
-        pdi.IE_list.append(fteid)
+        pdi_ies.append(fteid)
         # Add outer header removal instruction to PDR
-        outer_header_removal = pfcp.IE_OuterHeaderRemoval()
-        outer_header_removal.header = 0
-        pdr.IE_list.append(outer_header_removal)
+        pdr_ies.append(frozen_ie(pfcp.IE_OuterHeaderRemoval, header=0))
     else:
         if session.ue_addr is None:
             raise Exception("UE address required for downlink PDRs!")
@@ -300,20 +529,17 @@ def craft_pdr(session: Session, flow: UeFlow, src_iface: int, from_tunnel=False,
         _ue_addr = pfcp.IE_UE_IP_Address()
         _ue_addr.V4 = 1
         _ue_addr.ipv4 = session.ue_addr
-        pdi.IE_list.append(_ue_addr)
+        pdi_ies.append(_ue_addr)
         # If its not from a tunnel, then its from the internet
-        net_instance = pfcp.IE_NetworkInstance()
-        net_instance.instance = "internetinternetinternetinterne"
-        pdi.IE_list.append(net_instance)
+        pdi_ies.append(
+            frozen_ie(pfcp.IE_NetworkInstance, instance="internetinternetinternetinterne"))
 
     # Add a fully wildcard SDF filter
-    sdf = pfcp.IE_SDF_Filter()
-    sdf.FD = 1
     # FIXME: the SDF Filter is not spec-compliant. We should fix it once SD-Core supports the spec-compliant format.
-    sdf.flow_description = "permit out udp from 140.0.200.1 to assigned 80-80"
-    pdi.IE_list.append(sdf)
-
-    pdr.IE_list.append(pdi)
+    pdi_ies.append(
+        frozen_ie(pfcp.IE_SDF_Filter, FD=1,
+                  flow_description="permit out udp from 140.0.200.1 to assigned 80-80"))
+    pdi.IE_list = pdi_ies
 
     # Add all rule IDs
     _far_id = pfcp.IE_FAR_Id()
@@ -322,9 +548,8 @@ def craft_pdr(session: Session, flow: UeFlow, src_iface: int, from_tunnel=False,
     _qer_id.id = flow.qer_id
     _urr_id = pfcp.IE_URR_Id()
     _urr_id.id = flow.urr_id
-    pdr.IE_list.append(_far_id)
-    pdr.IE_list.append(_qer_id)
-    pdr.IE_list.append(_urr_id)
+    pdr_ies.extend((pdi, _far_id, _qer_id, _urr_id))
+    pdr.IE_list = pdr_ies
 
     return pdr
 
@@ -336,22 +561,11 @@ def craft_far(session: Session, far_id: int, forward_flag=False, drop_flag=False
     far = pfcp.IE_UpdateFAR() if update else pfcp.IE_CreateFAR()
     _far_id = pfcp.IE_FAR_Id()
     _far_id.id = far_id
-    far.IE_list.append(_far_id)
-
-    # Apply Action
-    apply_action = pfcp.IE_ApplyAction()
-    apply_action.FORW = int(forward_flag)
-    apply_action.DROP = int(drop_flag)
-    apply_action.BUFF = int(buffer_flag)
-    apply_action.NOCP = int(notifycp_flag)
-    far.IE_list.append(apply_action)
 
     # Forwarding Parameters
     forward_param = pfcp.IE_ForwardingParameters(
     ) if not update else pfcp.IE_UpdateForwardingParameters()
-    _dst_iface = pfcp.IE_DestinationInterface()
-    _dst_iface.interface = dst_iface
-    forward_param.IE_list.append(_dst_iface)
+    forward_param_ies = [frozen_ie(pfcp.IE_DestinationInterface, interface=dst_iface)]
 
     if tunnel:
         if (not buffer_flag) and tunnel_dst is None or teid is None:
@@ -360,9 +574,15 @@ def craft_far(session: Session, far_id: int, forward_flag=False, drop_flag=False
         outer_header.GTPUUDPIPV4 = 1
         outer_header.ipv4 = tunnel_dst
         outer_header.TEID = teid if not buffer_flag else 0  # FARs that buffer have a TEID of zero
-        forward_param.IE_list.append(outer_header)
-
-    far.IE_list.append(forward_param)
+        forward_param_ies.append(outer_header)
+    forward_param.IE_list = forward_param_ies
+
+    # FAR ID, then Apply Action, then the forwarding parameters
+    far.IE_list = [
+        _far_id,
+        frozen_ie(pfcp.IE_ApplyAction, FORW=int(forward_flag), DROP=int(drop_flag),
+                  BUFF=int(buffer_flag), NOCP=int(notifycp_flag)), forward_param
+    ]
     return far
 
 
@@ -372,20 +592,13 @@ def craft_qer(session: Session, qer_id: int, max_bitrate_up=12345678, max_bitrat
     # QER ID
     _qer_id = pfcp.IE_QER_Id()
     _qer_id.id = qer_id
-    qer.IE_list.append(_qer_id)
-    # Gate Status
-    gate1 = pfcp.IE_GateStatus()
-    qer.IE_list.append(gate1)
-    # Maximum Bitrate
-    max_bitrate = pfcp.IE_MBR()
-    max_bitrate.ul = max_bitrate_up
-    max_bitrate.dl = max_bitrate_down
-    qer.IE_list.append(max_bitrate)
-    # Guaranteed Bitrate
-    guaranteed_bitrate = pfcp.IE_GBR()
-    guaranteed_bitrate.ul = guaranteed_bitrate_up
-    guaranteed_bitrate.dl = guaranteed_bitrate_down
-    qer.IE_list.append(guaranteed_bitrate)
+    # QER ID, Gate Status, Maximum Bitrate, Guaranteed Bitrate
+    qer.IE_list = [
+        _qer_id,
+        frozen_ie(pfcp.IE_GateStatus),
+        frozen_ie(pfcp.IE_MBR, ul=max_bitrate_up, dl=max_bitrate_down),
+        frozen_ie(pfcp.IE_GBR, ul=guaranteed_bitrate_up, dl=guaranteed_bitrate_down)
+    ]
     return qer
 
 
@@ -394,27 +607,14 @@ def craft_urr(session: Session, urr_id: int, quota: int, threshold: int) -> pfcp
     # URR ID
     _urr_id = pfcp.IE_URR_Id()
     _urr_id.id = urr_id
-    urr.IE_list.append(_urr_id)
-    # Measurement Method
-    measure_method = pfcp.IE_MeasurementMethod()
-    measure_method.VOLUM = 1
-    urr.IE_list.append(measure_method)
-    # Report trigger
-    report_trigger = pfcp.IE_ReportingTriggers()
-    report_trigger.volume_threshold = 1
-    report_trigger.volume_quota = 1
-    urr.IE_list.append(report_trigger)
-    # Volume quota
-    volume_quota = pfcp.IE_VolumeQuota()
-    volume_quota.TOVOL = 1
-    volume_quota.total = quota
-    urr.IE_list.append(volume_quota)
-    # Volume threshold
-    volume_threshold = pfcp.IE_VolumeThreshold()
-    volume_threshold.TOVOL = 1
-    volume_threshold.total = threshold
-    urr.IE_list.append(volume_threshold)
-
+    # URR ID, Measurement Method, Report trigger, Volume quota, Volume threshold
+    urr.IE_list = [
+        _urr_id,
+        frozen_ie(pfcp.IE_MeasurementMethod, VOLUM=1),
+        frozen_ie(pfcp.IE_ReportingTriggers, volume_threshold=1, volume_quota=1),
+        frozen_ie(pfcp.IE_VolumeQuota, TOVOL=1, total=quota),
+        frozen_ie(pfcp.IE_VolumeThreshold, TOVOL=1, total=threshold)
+    ]
     return urr
 
 
@@ -427,11 +627,8 @@ def craft_pfcp_association_setup_packet() -> scapy.Packet:
     # Let's add IEs into the message
     ie1 = pfcp.IE_NodeId()
     ie1.ipv4 = our_addr
-    setup_request.IE_list.append(ie1)
-    ie2 = pfcp.IE_RecoveryTimeStamp()
-    setup_request.IE_list.append(ie2)
-    return IP(src=our_addr, dst=peer_addr) / UDP(sport=our_port,
-                                                 dport=peer_port) / pfcp_header / setup_request
+    setup_request.IE_list = [ie1, pfcp.IE_RecoveryTimeStamp()]
+    return pfcp_header / setup_request
 
 
 def craft_pfcp_association_release_packet() -> scapy.Packet:
@@ -442,9 +639,8 @@ def craft_pfcp_association_release_packet() -> scapy.Packet:
     # Let's add IEs into the message
     ie1 = pfcp.IE_NodeId()
     ie1.ipv4 = our_addr
-    release_request.IE_list.append(ie1)
-    return IP(src=our_addr, dst=peer_addr) / UDP(sport=our_port,
-                                                 dport=peer_port) / pfcp_header / release_request
+    release_request.IE_list = [ie1]
+    return pfcp_header / release_request
 
 
 def craft_pfcp_session_est_packet(args: argparse.Namespace, session: Session) -> scapy.Packet:
@@ -457,20 +653,15 @@ def craft_pfcp_session_est_packet(args: argparse.Namespace, session: Session) ->
 
     establishment_request = pfcp.PFCPSessionEstablishmentRequest()
     # add IEs into message
-    nodeid = pfcp.IE_NodeId()
-    nodeid.ipv4 = our_addr
-    establishment_request.IE_list.append(nodeid)
-
-    fseid = craft_fseid(session.our_seid, our_addr)
-    establishment_request.IE_list.append(fseid)
-
-    pdn_type = pfcp.IE_PDNType()
-    establishment_request.IE_list.append(pdn_type)
+    establishment_request.IE_list = [
+        frozen_ie(pfcp.IE_NodeId, ipv4=our_addr),
+        craft_fseid(session.our_seid, our_addr),
+        frozen_ie(pfcp.IE_PDNType)
+    ]
 
     session.add_rules_to_request(args=args, request=establishment_request)
 
-    return IP(src=our_addr, dst=peer_addr) / UDP(
-        sport=our_port, dport=peer_port) / pfcp_header / establishment_request
+    return pfcp_header / establishment_request
 
 
 def craft_pfcp_session_modify_packet(args: argparse.Namespace, session: Session) -> scapy.Packet:
@@ -485,14 +676,12 @@ def craft_pfcp_session_modify_packet(args: argparse.Namespace, session: Session)
     pfcp_header.seq = get_sequence_num()
 
     modification_request = pfcp.PFCPSessionModificationRequest()
-    fseid = craft_fseid(session.our_seid, our_addr)
-    modification_request.IE_list.append(fseid)
+    modification_request.IE_list = [craft_fseid(session.our_seid, our_addr)]
 
     session.add_rules_to_request(args, modification_request, add_pdrs=False, add_urrs=False,
                                  add_qers=False)
 
-    return IP(src=our_addr, dst=peer_addr) / UDP(
-        sport=our_port, dport=peer_port) / pfcp_header / modification_request
+    return pfcp_header / modification_request
 
 
 def craft_pfcp_session_delete_packet(session: Session) -> scapy.Packet:
@@ -506,12 +695,9 @@ def craft_pfcp_session_delete_packet(session: Session) -> scapy.Packet:
     pfcp_header.seq = get_sequence_num()
 
     deletion_request = pfcp.PFCPSessionDeletionRequest()
-    fseid = craft_fseid(session.our_seid, our_addr)
-    deletion_request.IE_list.append(fseid)
+    deletion_request.IE_list = [craft_fseid(session.our_seid, our_addr)]
 
-    delete_pkt = IP(src=our_addr, dst=peer_addr) / UDP(
-        sport=our_port, dport=peer_port) / pfcp_header / deletion_request
-    return delete_pkt
+    return pfcp_header / deletion_request
 
 
 def send_recv_pfcp(pkt: scapy.Packet, expected_response_type: int, session: Optional[Session],
@@ -529,31 +715,80 @@ def send_recv_pfcp(pkt: scapy.Packet, expected_response_type: int, session: Opti
     if verbosity_override > 1:
         pkt.show()
     capture(pkt)
-    response = scapy.sr1(pkt, verbose=verbosity_override)
-    if response is None:
+    seq = pkt[pfcp.PFCP].seq
+    with exchange_lock:
+        try:
+            sock.send(scapy.raw(pkt[pfcp.PFCP]))
+            while True:
+                data = sock.recv(RECV_BUFFER_SIZE)
+                if pfcp_message_seq(data) == seq:
+                    break
+                # Not the response to the request we just sent (e.g. a stale reply
+                # from an earlier timeout), keep waiting for ours
+        except OSError:
+            # Either the response timed out, or the peer isn't listening yet: on a
+            # connect()ed UDP socket the ICMP port unreachable comes back as
+            # ConnectionRefusedError raised from send()/recv()
+            return False
+    if pcap_writer or verbosity_override > 1:
+        # Full dissection is only needed to pretty-print or capture the response
+        response = pfcp.PFCP(data)
+        capture(response, from_peer=True)
+        if verbosity_override > 1:
+            response.show()
+    return handle_pfcp_response(data, expected_response_type, session)
+
+
+def pfcp_message_seq(data: bytes) -> int:
+    """
+    Extract the sequence number from a serialized PFCP message without dissecting it.
+    :param data: the serialized PFCP message
+    :return: the sequence number in the message header
+    """
+    # The sequence number follows the 8-byte SEID when the S flag (bit 0) is set
+    offset = 12 if data[0] & 0x1 else 4
+    return int.from_bytes(data[offset:offset + 3], "big")
+
+
+def handle_pfcp_response(data: bytes, expected_response_type: int,
+                         session: Optional[Session]) -> bool:
+    """
+    Check a serialized PFCP response against the expected message type, and store the
+    peer SEID if the response carries one. The message type comes straight out of the
+    fixed header and the Cause/F-SEID IEs out of a flat TLV walk with struct, so the
+    expected-response hot path never pays for a full scapy dissection.
+    :param data: the serialized PFCP response
+    :param expected_response_type: The expected PFCP message type of the response
+    :param session: the session the response is associated with, or None for session-less messages
+    :return: True if no errors are encountered, false otherwise
+    """
+    if len(data) < 8:
+        print("ERROR: received a truncated PFCP message of %d bytes" % len(data))
         return False
-    capture(response)
-    if verbosity_override > 1:
-        response.show()
-    if response.message_type == expected_response_type:
-        for ie in response.payload.IE_list:
-            if ie.ie_type == IE_TYPES["Cause"]:
-                if ie.cause not in [CAUSE_TYPES["Reserved"], CAUSE_TYPES["Request accepted"]]:
-                    response_type_str = pfcp.PFCPmessageType[response.message_type]
-                    print("ERROR in PFCP message of type %s: %s" %
-                          (response_type_str, pfcp.CauseValues[ie.cause]))
-                    return False
-            elif ie.ie_type == IE_TYPES["F-SEID"]:
-                if session is None:
-                    raise Exception(
-                        "Received PFCP response with session ID that we have no Session object to save to!"
-                    )
-                session.set_peer_seid(int(ie.seid))
-    else:
+    flags, message_type = _PFCP_MSG_HEADER_STRUCT.unpack_from(data, 0)
+    if message_type != expected_response_type:
         print("ERROR: Expected response of type %s but received %s" %
               (pfcp.PFCPmessageType[expected_response_type],
-               pfcp.PFCPmessageType[response.message_type]))
+               pfcp.PFCPmessageType.get(message_type, message_type)))
         return False
+    # Walk the top-level IE TLVs, right after the 8 or 16 byte header
+    offset = 16 if flags & 0x1 else 8
+    while offset + 4 <= len(data):
+        ie_type, ie_len = _IE_HEADER_STRUCT.unpack_from(data, offset)
+        if ie_type == IE_TYPES["Cause"]:
+            cause = data[offset + 4]
+            if cause not in (CAUSE_TYPES["Reserved"], CAUSE_TYPES["Request accepted"]):
+                print("ERROR in PFCP message of type %s: %s" %
+                      (pfcp.PFCPmessageType[message_type], pfcp.CauseValues.get(cause, cause)))
+                return False
+        elif ie_type == IE_TYPES["F-SEID"]:
+            if session is None:
+                raise Exception(
+                    "Received PFCP response with session ID that we have no Session object to save to!"
+                )
+            # One flag byte, then the 8-byte SEID
+            session.set_peer_seid(_SEID_STRUCT.unpack_from(data, offset + 5)[0])
+        offset += 4 + ie_len
     return True
 
 
@@ -573,44 +808,115 @@ def teardown_pfcp_association(args: argparse.Namespace) -> None:
     active_sessions.clear()
 
 
+def send_recv_pfcp_batch(pkts_with_sessions, expected_response_type: int):
+    """
+    Send a batch of session-associated PFCP requests via send_batch(), then drain the
+    responses, matching each one back to its session by sequence number. Crafting all
+    requests up front before touching the network keeps the per-session work out of
+    the response round-trips.
+    :param pkts_with_sessions: a list of (packet, session) tuples to send
+    :param expected_response_type: The expected PFCP message type of the responses
+    :return: a list of (session, ok) tuples for every session whose response arrived,
+    where ok is the handle_pfcp_response() verdict
+    """
+    sessions_by_seq = {pkt[pfcp.PFCP].seq: session for pkt, session in pkts_with_sessions}
+    results = []
+    with exchange_lock:
+        try:
+            send_batch([pkt for pkt, _ in pkts_with_sessions])
+            # Drain until every request is answered rather than counting datagrams, so
+            # a foreign datagram in the queue doesn't eat the slot of a real response
+            while sessions_by_seq:
+                data = sock.recv(RECV_BUFFER_SIZE)
+                session = sessions_by_seq.pop(pfcp_message_seq(data), None)
+                if session is None:
+                    # Not a response to this batch (e.g. a stale reply from an earlier timeout)
+                    continue
+                if pcap_writer:
+                    capture(pfcp.PFCP(data), from_peer=True)
+                results.append(
+                    (session, handle_pfcp_response(data, expected_response_type, session)))
+        except OSError:
+            # Either the responses timed out, or the peer isn't listening: on a
+            # connect()ed UDP socket the ICMP port unreachable comes back as
+            # ConnectionRefusedError raised from the send/recv calls
+            print("ERROR: no response to messages of type %s" %
+                  pfcp.PFCPmessageType[expected_response_type])
+    return results
+
+
 def create_pfcp_sessions(args: argparse.Namespace) -> None:
+    if args.sleep_time:
+        for session in get_sessions_from_args(args, create_if_missing=True):
+            if verbosity > 0:
+                print("Creating session with SEID %d" % session.our_seid)
+            pkt = craft_pfcp_session_est_packet(args, session)
+            send_recv_pfcp(pkt, MSG_TYPES["session_establishment_response"], session)
+            time.sleep(args.sleep_time)  # sleep before the next session creation
+        return
+    pkts_with_sessions = []
     for session in get_sessions_from_args(args, create_if_missing=True):
         if verbosity > 0:
             print("Creating session with SEID %d" % session.our_seid)
-        pkt = craft_pfcp_session_est_packet(args, session)
-        send_recv_pfcp(pkt, MSG_TYPES["session_establishment_response"], session)
-        time.sleep(args.sleep_time)  # sleep before the next session creation
+        pkts_with_sessions.append((craft_pfcp_session_est_packet(args, session), session))
+    send_recv_pfcp_batch(pkts_with_sessions, MSG_TYPES["session_establishment_response"])
 
 
 def modify_pfcp_sessions(args: argparse.Namespace) -> None:
+    if args.sleep_time:
+        for session in get_sessions_from_args(args, create_if_missing=False):
+            if verbosity > 0:
+                print("Modifying session with SEID %d" % session.our_seid)
+            pkt = craft_pfcp_session_modify_packet(args, session)
+            send_recv_pfcp(pkt, MSG_TYPES["session_modification_response"], session)
+            time.sleep(args.sleep_time)  # sleep before the next session modification
+        return
+    pkts_with_sessions = []
     for session in get_sessions_from_args(args, create_if_missing=False):
         if verbosity > 0:
             print("Modifying session with SEID %d" % session.our_seid)
-        pkt = craft_pfcp_session_modify_packet(args, session)
-        send_recv_pfcp(pkt, MSG_TYPES["session_modification_response"], session)
-        time.sleep(args.sleep_time)  # sleep before the next session modification
+        pkts_with_sessions.append((craft_pfcp_session_modify_packet(args, session), session))
+    send_recv_pfcp_batch(pkts_with_sessions, MSG_TYPES["session_modification_response"])
 
 
 def delete_pfcp_sessions(args: argparse.Namespace) -> None:
+    if args.sleep_time:
+        for session in get_sessions_from_args(args, create_if_missing=False):
+            if verbosity > 0:
+                print("Deleting session with SEID %d" % session.our_seid)
+            pkt = craft_pfcp_session_delete_packet(session)
+            # Only forget the session once the UPF actually acknowledged the deletion,
+            # otherwise it lives on in the UPF but can no longer be addressed from here
+            if send_recv_pfcp(pkt, MSG_TYPES["session_deletion_response"], session):
+                del active_sessions[session.our_seid]
+            else:
+                print("WARNING: session with SEID %d was not deleted" % session.our_seid)
+            time.sleep(args.sleep_time)  # sleep before the next session deletion
+        return
+    pkts_with_sessions = []
     for session in get_sessions_from_args(args, create_if_missing=False):
         if verbosity > 0:
             print("Deleting session with SEID %d" % session.our_seid)
-        pkt = craft_pfcp_session_delete_packet(session)
-        send_recv_pfcp(pkt, MSG_TYPES["session_deletion_response"], session)
-        del active_sessions[session.our_seid]
-        time.sleep(args.sleep_time)  # sleep before the next session deletion
+        pkts_with_sessions.append((craft_pfcp_session_delete_packet(session), session))
+    for session, ok in send_recv_pfcp_batch(pkts_with_sessions,
+                                            MSG_TYPES["session_deletion_response"]):
+        if ok:
+            del active_sessions[session.our_seid]
+        else:
+            print("WARNING: session with SEID %d was not deleted" % session.our_seid)
 
 
 def send_pfcp_heartbeats() -> None:
-    while True:
-        for _ in range(HEARTBEAT_PERIOD):
-            # semi-busy wait
-            time.sleep(1)
-            if script_terminating:
-                return
+    # Block on the termination event instead of polling a flag once a second;
+    # wait() returns True as soon as terminate() sets the event
+    while not terminate_event.wait(HEARTBEAT_PERIOD):
         if not association_established:
             # Don't heartbeat unless an association is currently established
             continue
+        if exchange_lock.locked():
+            # A user-triggered exchange is in flight on the shared socket; skip
+            # this tick rather than queuing a heartbeat behind it
+            continue
         pfcp_header = pfcp.PFCP()
         pfcp_header.version = 1
         pfcp_header.S = 0  # SEID flag false
@@ -619,10 +925,9 @@ def send_pfcp_heartbeats() -> None:
 
         heartbeat = pfcp.PFCPHeartbeatRequest()
         heartbeat.version = 1
-        heartbeat.IE_list.append(pfcp.IE_RecoveryTimeStamp())
+        heartbeat.IE_list = [pfcp.IE_RecoveryTimeStamp()]
 
-        pkt = IP(src=our_addr, dst=peer_addr) / UDP(sport=our_port,
-                                                    dport=peer_port) / pfcp_header / heartbeat
+        pkt = pfcp_header / heartbeat
         send_recv_pfcp(pkt, MSG_TYPES["heartbeat_response"], session=None, verbosity_override=0)
 
 
@@ -640,17 +945,16 @@ def interrupt_association(args: argparse.Namespace) -> None:
 
 
 def terminate(args: argparse.Namespace) -> None:
-    global script_terminating
     if association_established:
         print("Exiting before association deleted. Deleting..")
         delete_pfcp_sessions(args)
-    script_terminating = True
+    terminate_event.set()
+    if pcap_writer:
+        pcap_writer.close()
     exit()
 
 
 def handle_user_input(input_file: Optional[IO] = None, output_file: Optional[IO] = None) -> None:
-    global script_terminating
-
     user_choices = {
         "associate": ("Setup PFCP Association", setup_pfcp_association),
         "create": ("Create PFCP Session(s)", create_pfcp_sessions),
@@ -711,24 +1015,36 @@ def handle_user_input(input_file: Optional[IO] = None, output_file: Optional[IO]
                         help="The priority/precedence of PDRs.")
 
     def get_user_input():
+        nonlocal input_file
         if not input_file:
             return input("Enter your selection : ")
-        else:
-            # Poll the input file for an unread line
+        if stat.S_ISFIFO(os.fstat(input_file.fileno()).st_mode):
+            # A named pipe: readline() blocks in the kernel until a writer hands us a
+            # line. On EOF (all writers closed), reopening the FIFO blocks until the
+            # next writer appears, so no polling is needed at all.
             while True:
-                read_head = input_file.tell()
                 line = input_file.readline()
                 if line:
                     return line
-                time.sleep(0.5)
-                input_file.seek(read_head)
+                path = input_file.name
+                input_file.close()
+                input_file = open(path, "r")
+        # A regular file: select()/inotify can't block on appends through the page
+        # cache portably, so poll the file for an unread line
+        while True:
+            read_head = input_file.tell()
+            line = input_file.readline()
+            if line:
+                return line
+            time.sleep(0.5)
+            input_file.seek(read_head)
 
     while True:
         print("=" * 40)
         for choice, (action_desc, action) in user_choices.items():
             print("\"%s\" - %s" % (choice, action_desc))
         try:
-            args = parser.parse_args(input("Enter your selection : ").split())
+            args = parser.parse_args(get_user_input().split())
         except Exception as e:
             print(e)
             parser.print_help()
@@ -739,14 +1055,14 @@ def handle_user_input(input_file: Optional[IO] = None, output_file: Optional[IO]
             choice_func(args)
         except Exception as e:
             # Catch the exception just long enough to signal the heartbeat thread to end
-            script_terminating = True
+            terminate_event.set()
             raise e
 
 
 def main():
-    global our_addr, peer_addr, our_port, peer_port, pcap_filename
+    global our_addr, peer_addr, our_port, peer_port, pcap_writer
 
-    our_addr = ifcfg.interfaces()['eth0']['inet']
+    our_addr = get_iface_ipv4('eth0')
     our_port = UDP_PORT_PFCP
     peer_port = UDP_PORT_PFCP
 
@@ -771,9 +1087,10 @@ def main():
     if args.output_file:
         output_file = open(args.output_file, "w")
     if args.pcap_file:
-        # clear the pcap file
-        pcap_filename = args.pcap_file
-        open(pcap_filename, 'w').close()
+        # Keep one buffered writer open for the whole run instead of reopening and
+        # seeking to the end of the file for every captured packet
+        pcap_writer = PcapWriter(args.pcap_file, append=False, sync=False)
+        atexit.register(pcap_writer.close)
     global verbosity
     verbosity = args.verbose
     if args.sport:
@@ -790,6 +1107,8 @@ def main():
             print("Argument must be a valid hostname or address")
             exit(1)
 
+    open_socket()
+
     thread1 = Thread(target=handle_user_input, args=(input_file, output_file))
     thread2 = Thread(target=send_pfcp_heartbeats)
 